@@ -1,40 +1,77 @@
-import supervision as sv
 import sys
 import os
 import torch
-import urllib.request
-from typing import Optional, Union, Any
+from typing import Optional, Any
 from pathlib import Path
 import warnings
 import traceback
+import importlib
+import importlib.util
+import hashlib
+import json
+import mmap
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
 warnings.filterwarnings('ignore')
 
 ABS_PROJECT_DIR = Path(__file__).parent.parent.absolute()
 
+# Resolved once, on first use: torch.cuda.is_available() initialises the driver,
+# which CPU-only imports of this module should not pay for
+@functools.lru_cache(maxsize=1)
 def get_device():
     try:
         if torch.cuda.is_available():
             device = torch.device("cuda")
         else:
             device = torch.device("cpu")
-        return device
     except Exception as e:
         print(f"Warning: Could not initialize CUDA device, falling back to CPU: {e}")
-        return torch.device("cpu")
-
-DEVICE = None
+        device = torch.device("cpu")
+    print(f"Initialized device: {device}")
+    return device
+
+# Precision of the MobileSAM image encoder on CUDA. DTYPE=bf16|fp16|fp32 overrides
+# the default of bf16 on Ampere and newer and fp16 on older GPUs; CPU stays fp32.
+ENCODER_DTYPES = {"bf16": torch.bfloat16, "bfloat16": torch.bfloat16, "fp16": torch.float16,
+                  "float16": torch.float16, "fp32": torch.float32, "float32": torch.float32}
+
+@functools.lru_cache(maxsize=1)
+def get_encoder_dtype() -> torch.dtype:
+    if get_device().type != "cuda":
+        return torch.float32
+    requested = os.environ.get("DTYPE", "").lower()
+    if requested in ENCODER_DTYPES:
+        return ENCODER_DTYPES[requested]
+    if requested:
+        print(f"Warning: unknown DTYPE {requested!r}, using the default")
+    return torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+
+# torch.compile the models on CUDA; SAM_COMPILE=0 or MODEL_LOADER_COMPILE=0 keeps
+# them in eager mode
+SAM_COMPILE = os.environ.get("MODEL_LOADER_COMPILE", os.environ.get("SAM_COMPILE", "1")) != "0"
+# USE_TRT=1 swaps the MobileSAM image encoder for a TensorRT engine (needs torch2trt)
+USE_TRT = os.environ.get("USE_TRT", "0") == "1"
+# Largest batch the webapp hands the encoder (app.MAX_BATCH)
+TRT_MAX_BATCH = 4
 
 GROUNDING_DINO_DIR = ABS_PROJECT_DIR / "webapp" / "GroundingDINO"
 MOBILE_SAM_DIR = ABS_PROJECT_DIR / "webapp" / "MobileSAM"
 
-# Directories
-try:
-    GROUNDING_DINO_DIR.mkdir(parents=True, exist_ok=True)
-    MOBILE_SAM_DIR.mkdir(parents=True, exist_ok=True)
-    (MOBILE_SAM_DIR / "weights").mkdir(parents=True, exist_ok=True)
-    print("Directories created successfully")
-except Exception as e:
-    print(f"Warning: Could not create directories: {e}")
+# Directories, created on first setup rather than at import
+DIRS_NEEDED = [GROUNDING_DINO_DIR, MOBILE_SAM_DIR, MOBILE_SAM_DIR / "weights"]
+
+def ensure_dirs() -> None:
+    # One stat per directory on warm starts, and no writes
+    if all(directory.is_dir() for directory in DIRS_NEEDED):
+        return
+    try:
+        for directory in DIRS_NEEDED:
+            directory.mkdir(parents=True, exist_ok=True)
+        print("Directories created successfully")
+    except OSError as e:
+        print(f"Warning: Could not create directories: {e}")
 
 # Initialize model variables
 GroundingDINO: Optional[type] = None
@@ -43,16 +80,32 @@ SamPredictor: Optional[type] = None
 
 
 # ---------------- UTILS ----------------
+# Module names that failed to import, so the fallback chains below do not retry
+# them; cleared whenever sys.path grows, since that can make them importable
+_failed_imports: set = set()
+
+def cached_import(module_name: str):
+    module = sys.modules.get(module_name)
+    if module is not None:
+        return module
+    if module_name in _failed_imports:
+        raise ImportError(f"No module named {module_name!r} (cached failure)")
+    try:
+        return importlib.import_module(module_name)
+    except ImportError:
+        _failed_imports.add(module_name)
+        raise
+
 def safe_import(module_name: str, from_list: list = None, as_name: str = None):
     try:
+        module = cached_import(module_name)
         if from_list:
-            module = __import__(module_name, fromlist=from_list)
             if len(from_list) == 1:
                 return getattr(module, from_list[0])
             else:
                 return tuple(getattr(module, item) for item in from_list)
         else:
-            return __import__(module_name)
+            return module
     except ImportError as e:
         print(f"Import failed for {module_name}: {e}")
         return None
@@ -63,6 +116,7 @@ def safe_import(module_name: str, from_list: list = None, as_name: str = None):
 def add_to_path_if_exists(directory: Path) -> bool:
     if directory.exists() and str(directory) not in sys.path:
         sys.path.insert(0, str(directory))
+        _failed_imports.clear()
         print(f"Added {directory} to sys.path")
         return True
     return False
@@ -84,6 +138,9 @@ def import_grounding_dino() -> bool:
     package_variations = ['groundingdino', 'GroundingDINO', 'grounding_dino']
     for pkg in package_variations:
         try:
+            # find_spec only looks the package up; importing it runs its __init__
+            if importlib.util.find_spec(pkg) is None:
+                continue
             module = safe_import(pkg)
             if module:
                 inference_module = safe_import(f'{pkg}.util.inference', ['Model'])
@@ -95,7 +152,7 @@ def import_grounding_dino() -> bool:
             continue
     
     if GROUNDING_DINO_DIR.exists():
-        add_to_path_if_exists(GROUNDING_DINO_DIR)
+        # Each directory is put on sys.path once, then tried right away
         for path in [GROUNDING_DINO_DIR, GROUNDING_DINO_DIR / "groundingdino"]:
             if add_to_path_if_exists(path):
                 try:
@@ -163,40 +220,226 @@ def print_mobile_sam_installation_help():
 
 
 # ---------------- FILE SETUP ----------------
-def download_file_robust(url: str, destination: Path, description: str, max_retries: int = 3) -> bool:
-    if destination.exists() and destination.stat().st_size > 0:
-        print(f"{description} already exists at {destination}")
+# Large files are fetched as parallel HTTP range requests when the server allows it
+PARALLEL_DOWNLOAD_MIN_BYTES = 64 * 1024 * 1024
+PARALLEL_DOWNLOAD_WORKERS = 8
+
+@functools.lru_cache(maxsize=1)
+def http_session() -> Any:
+    # One keep-alive session for every download, so the two checkpoint downloads
+    # and their range workers reuse pooled connections instead of a fresh TLS
+    # handshake per request
+    import requests
+    from requests.adapters import HTTPAdapter
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=2 * PARALLEL_DOWNLOAD_WORKERS)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+def sha256_file(path: Path) -> str:
+    with open(path, "rb") as f:
+        if hasattr(hashlib, "file_digest"):
+            return hashlib.file_digest(f, "sha256").hexdigest()
+        digest = hashlib.sha256()
+        for block in iter(lambda: f.read(8 * 1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+# A .verified sidecar records the size, mtime and sha256 of a checked file, so
+# warm starts skip re-hashing a checkpoint that has not changed since
+def verified_sidecar_path(destination: Path) -> Path:
+    return destination.with_name(destination.name + ".verified")
+
+def record_verified(destination: Path, sha256: str) -> None:
+    try:
+        stat = destination.stat()
+        verified_sidecar_path(destination).write_text(
+            json.dumps({"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": sha256}))
+    except OSError as e:
+        print(f"Could not record checksum for {destination}: {e}")
+
+def existing_file_valid(destination: Path, stat: os.stat_result, description: str,
+                        expected_sha256: Optional[str]) -> bool:
+    if not expected_sha256:
+        return True
+    expected_sha256 = expected_sha256.lower()
+    try:
+        record = json.loads(verified_sidecar_path(destination).read_text())
+    except (OSError, ValueError):
+        record = None
+    if record == {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": expected_sha256}:
         return True
+
+    print(f"Verifying {description}...")
+    sha256 = sha256_file(destination)
+    if sha256 != expected_sha256:
+        print(f"{description} checksum mismatch ({sha256}), downloading again")
+        return False
+    record_verified(destination, sha256)
+    return True
+
+def finish_download(part_path: Path, destination: Path, description: str, sha256: str,
+                    expected_sha256: Optional[str]) -> None:
+    print(f"{description} sha256: {sha256}")
+    if expected_sha256 and sha256 != expected_sha256.lower():
+        part_path.unlink()
+        raise ValueError(f"checksum mismatch, expected {expected_sha256}")
+    os.replace(part_path, destination)
+    record_verified(destination, sha256)
+    print(f"{description} downloaded successfully")
+
+def download_parallel(session: Any, url: str, part_path: Path, max_retries: int) -> bool:
+    # Returns False when the server cannot serve ranges or the file is small, so
+    # the caller falls back to a single stream
+    head = session.head(url, allow_redirects=True, timeout=30)
+    total_size = int(head.headers.get("Content-Length", 0))
+    if head.headers.get("Accept-Ranges") != "bytes" or total_size < PARALLEL_DOWNLOAD_MIN_BYTES:
+        return False
+    url = head.url  # follow the redirect once instead of in every worker
+
+    print(f"Downloading {total_size} bytes in {PARALLEL_DOWNLOAD_WORKERS} parallel ranges")
+    chunk_size = -(-total_size // PARALLEL_DOWNLOAD_WORKERS)
+    ranges = [(lo, min(lo + chunk_size, total_size) - 1) for lo in range(0, total_size, chunk_size)]
+    fd = os.open(part_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        if hasattr(os, "posix_fallocate"):
+            os.posix_fallocate(fd, 0, total_size)
+        else:
+            os.ftruncate(fd, total_size)
+
+        def fetch(byte_range: tuple[int, int]) -> None:
+            offset, end = byte_range
+            for attempt in range(1, max_retries + 1):
+                try:
+                    # A retry picks up where this range stopped
+                    headers = {"Range": f"bytes={offset}-{end}"}
+                    with session.get(url, stream=True, headers=headers, timeout=30) as response:
+                        if response.status_code != 206:
+                            raise ValueError(f"range request answered with {response.status_code}")
+                        for chunk in response.iter_content(1024 * 1024):
+                            os.pwrite(fd, chunk, offset)
+                            offset += len(chunk)
+                    if offset != end + 1:
+                        raise ValueError(f"range ended at {offset}, expected {end + 1}")
+                    return
+                except Exception as e:
+                    if attempt == max_retries:
+                        raise
+                    print(f"Range {byte_range[0]}-{end} failed (attempt {attempt}/{max_retries}): {e}")
+
+        with ThreadPoolExecutor(max_workers=PARALLEL_DOWNLOAD_WORKERS) as pool:
+            list(pool.map(fetch, ranges))
+    except Exception:
+        # A partly filled file cannot be resumed by size, unlike a sequential .part
+        os.close(fd)
+        part_path.unlink()
+        raise
+    os.close(fd)
+    return True
+
+def download_file_robust(url: str, destination: Path, description: str, max_retries: int = 3,
+                         expected_sha256: Optional[str] = None) -> bool:
+    # One stat call answers both "exists" and "non-empty"
+    try:
+        stat = destination.stat()
+    except OSError:
+        stat = None
+    if stat is not None and stat.st_size > 0:
+        if existing_file_valid(destination, stat, description, expected_sha256):
+            print(f"{description} already exists at {destination}")
+            return True
+        destination.unlink()
     
     print(f"Downloading {description}...")
     destination.parent.mkdir(parents=True, exist_ok=True)
     
+    # Download into a .part file and rename it into place when complete, so an
+    # interrupted download never passes the exists() check above and can resume
+    part_path = destination.with_name(destination.name + ".part")
+    # Parallel ranges go to their own preallocated file. It cannot be resumed by
+    # size, so one left behind by a killed process is discarded.
+    parallel_part_path = destination.with_name(destination.name + ".parallel.part")
+    parallel_part_path.unlink(missing_ok=True)
     try:
-        import requests
-        response = requests.get(url, stream=True)
-        response.raise_for_status()
-        with open(destination, "wb") as f:
-            for chunk in response.iter_content(8192):
-                if chunk:
-                    f.write(chunk)
-        print(f"{description} downloaded successfully")
-        return True
-    except Exception as e:
+        session = http_session()
+    except ImportError as e:
         print(f"Download failed: {e}")
         return False
 
+    # A fresh download of a large file goes through parallel ranges; a leftover
+    # .part from a sequential download is resumed below instead
+    if not part_path.exists() and hasattr(os, "pwrite"):
+        try:
+            if download_parallel(session, url, parallel_part_path, max_retries):
+                # Hashed from the page cache, since ranges arrive out of order
+                finish_download(parallel_part_path, destination, description,
+                                sha256_file(parallel_part_path), expected_sha256)
+                return True
+        except Exception as e:
+            print(f"Parallel download failed, falling back to a single stream: {e}")
+
+    for attempt in range(1, max_retries + 1):
+        try:
+            resume_from = part_path.stat().st_size if part_path.exists() else 0
+            headers = {"Range": f"bytes={resume_from}-"} if resume_from else {}
+            with session.get(url, stream=True, headers=headers, timeout=30) as response:
+                if response.status_code == 416:
+                    # The .part is no prefix of the file (e.g. already full size); start over
+                    part_path.unlink()
+                response.raise_for_status()
+                # 206 means the server honoured the range; otherwise start over
+                mode = "ab" if response.status_code == 206 else "wb"
+                # SHA-256 is computed in the same pass as the write, so checking
+                # it costs no extra I/O (only an already-downloaded prefix is re-read)
+                digest = hashlib.sha256()
+                if mode == "ab":
+                    print(f"Resuming {description} from {resume_from} bytes")
+                    with open(part_path, "rb") as f:
+                        for block in iter(lambda: f.read(8 * 1024 * 1024), b""):
+                            digest.update(block)
+                with open(part_path, mode) as f:
+                    for chunk in response.iter_content(8 * 1024 * 1024):
+                        if chunk:
+                            digest.update(chunk)
+                            f.write(chunk)
+            finish_download(part_path, destination, description, digest.hexdigest(), expected_sha256)
+            return True
+        except Exception as e:
+            print(f"Download failed (attempt {attempt}/{max_retries}): {e}")
+    return False
+
+CONFIG_NAME = "GroundingDINO_SwinT_OGC.py"
+# Remembers where the tree search found the config, for the next start
+CONFIG_PATH_CACHE = GROUNDING_DINO_DIR / ".config_path_cache"
+
 def find_config_file() -> Optional[Path]:
-    for root, dirs, files in os.walk(GROUNDING_DINO_DIR):
-        if "GroundingDINO_SwinT_OGC.py" in files:
-            return Path(root) / "GroundingDINO_SwinT_OGC.py"
-    return None
+    candidates = [GROUNDING_DINO_DIR / "groundingdino" / "config" / CONFIG_NAME, GROUNDING_DINO_DIR / CONFIG_NAME]
+    try:
+        candidates.insert(0, Path(CONFIG_PATH_CACHE.read_text().strip()))
+    except OSError:
+        pass
+    for candidate in candidates:
+        if candidate.is_file():
+            return candidate
+
+    # rglob stops at the first match instead of walking the whole tree
+    config_path = next(GROUNDING_DINO_DIR.rglob(CONFIG_NAME), None)
+    if config_path is not None:
+        try:
+            CONFIG_PATH_CACHE.write_text(str(config_path))
+        except OSError:
+            pass
+    return config_path
 
 def setup_grounding_dino_files() -> tuple[bool, Optional[Path]]:
     print("Setting up GroundingDINO files...")
+    ensure_dirs()
     checkpoint_url = "https://huggingface.co/ShilongLiu/GroundingDINO/resolve/main/groundingdino_swint_ogc.pth"
     checkpoint_path = GROUNDING_DINO_DIR / "groundingdino_swint_ogc.pth"
     
-    checkpoint_ready = download_file_robust(checkpoint_url, checkpoint_path, "GroundingDINO checkpoint")
+    checkpoint_ready = download_file_robust(checkpoint_url, checkpoint_path, "GroundingDINO checkpoint",
+                                            expected_sha256=os.environ.get("GROUNDING_DINO_SHA256"))
     config_path = find_config_file()
     
     if not config_path:
@@ -207,9 +450,98 @@ def setup_grounding_dino_files() -> tuple[bool, Optional[Path]]:
 
 def setup_mobile_sam_files() -> bool:
     print("Setting up MobileSAM files...")
+    ensure_dirs()
     url = "https://github.com/ChaoningZhang/MobileSAM/raw/master/weights/mobile_sam.pt"
     checkpoint_path = MOBILE_SAM_DIR / "weights" / "mobile_sam.pt"
-    return download_file_robust(url, checkpoint_path, "MobileSAM checkpoint")
+    return download_file_robust(url, checkpoint_path, "MobileSAM checkpoint",
+                                expected_sha256=os.environ.get("MOBILE_SAM_SHA256"))
+
+
+# ---------------- OPTIMIZED CHECKPOINTS ----------------
+# After the first load, the MobileSAM state dict is rewritten as one raw file with
+# every tensor at a 4 KiB-aligned offset, plus a JSON index of
+# name -> [offset, nbytes, shape, dtype]. Later loads memory-map that file and
+# wrap each tensor with torch.frombuffer, with no unpickling or copies. The index
+# records the size and mtime of the checkpoint it was built from, so a replaced
+# checkpoint is never shadowed by a stale copy.
+OPT_ALIGN = 4096
+
+def optimized_checkpoint_paths(checkpoint_path: Path) -> tuple[Path, Path]:
+    return checkpoint_path.with_suffix(".opt.bin"), checkpoint_path.with_suffix(".opt.json")
+
+def checkpoint_signature(checkpoint_path: Path) -> dict:
+    stat = checkpoint_path.stat()
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+def read_optimized_index(checkpoint_path: Path) -> Optional[dict]:
+    bin_path, index_path = optimized_checkpoint_paths(checkpoint_path)
+    if not index_path.exists() or not bin_path.exists():
+        return None
+    index = json.loads(index_path.read_text())
+    if index.get("source") != checkpoint_signature(checkpoint_path):
+        print(f"Optimized checkpoint is out of date with {checkpoint_path.name}, rebuilding")
+        return None
+    return index["tensors"]
+
+def save_optimized_checkpoint(state_dict: dict, checkpoint_path: Path) -> None:
+    bin_path, index_path = optimized_checkpoint_paths(checkpoint_path)
+    source = checkpoint_signature(checkpoint_path)
+    index = {}
+    offset = 0
+    part_path = bin_path.with_name(bin_path.name + ".part")
+    with open(part_path, "wb") as f:
+        for name, tensor in state_dict.items():
+            tensor = tensor.detach().cpu().contiguous()
+            offset = -(-offset // OPT_ALIGN) * OPT_ALIGN
+            f.seek(offset)
+            f.write(tensor.reshape(-1).view(torch.uint8).numpy().data)
+            nbytes = tensor.numel() * tensor.element_size()
+            index[name] = [offset, nbytes, list(tensor.shape), str(tensor.dtype).replace("torch.", "")]
+            offset += nbytes
+    os.replace(part_path, bin_path)
+    # The index is written last, so its presence means the data file is complete
+    index_path.write_text(json.dumps({"source": source, "tensors": index}))
+    print(f"Saved optimized checkpoint to {bin_path}")
+
+def load_optimized_checkpoint(checkpoint_path: Path) -> Optional[dict]:
+    index = read_optimized_index(checkpoint_path)
+    if index is None:
+        return None
+    bin_path, _ = optimized_checkpoint_paths(checkpoint_path)
+    with open(bin_path, "rb") as f:
+        # Copy-on-write mapping: torch.frombuffer wants a writable buffer
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    state_dict = {}
+    for name, (offset, nbytes, shape, dtype_name) in index.items():
+        dtype = getattr(torch, dtype_name)
+        if nbytes:
+            tensor = torch.frombuffer(buffer, dtype=dtype, count=nbytes // dtype.itemsize, offset=offset)
+        else:
+            tensor = torch.empty(0, dtype=dtype)
+        state_dict[name] = tensor.reshape(shape)
+    return state_dict
+
+def load_optimized_checkpoint_gds(checkpoint_path: Path, device: torch.device) -> Optional[dict]:
+    # With kvikio the whole file is read straight into one VRAM buffer (GPUDirect
+    # Storage when the host supports it, kvikio's own POSIX path otherwise) and
+    # each tensor is a view into it, skipping the pinned host copy
+    if device.type != "cuda" or importlib.util.find_spec("kvikio") is None:
+        return None
+    index = read_optimized_index(checkpoint_path)
+    if index is None:
+        return None
+    bin_path, _ = optimized_checkpoint_paths(checkpoint_path)
+    import kvikio
+    buffer = torch.empty(bin_path.stat().st_size, dtype=torch.uint8, device=device)
+    with kvikio.CuFile(bin_path, "r") as f:
+        f.read(buffer)
+    state_dict = {}
+    for name, (offset, nbytes, shape, dtype_name) in index.items():
+        dtype = getattr(torch, dtype_name)
+        # Offsets are 4 KiB-aligned, so every view is aligned for its dtype
+        state_dict[name] = buffer[offset:offset + nbytes].view(dtype).reshape(shape)
+    print(f"Read optimized checkpoint into {device} with kvikio")
+    return state_dict
 
 
 # ---------------- LOADING ----------------
@@ -236,55 +568,256 @@ def load_mobile_sam_model(checkpoint_path: Path, sam_type: str = "vit_t") -> Opt
     try:
         device = get_device()
         print(f"Using device: {device}")
-        sam = sam_model_registry[sam_type](checkpoint=str(checkpoint_path))
-        sam.to(device)
+        sam = sam_model_registry[sam_type]()
+        # Memory-map the checkpoint and adopt its tensors as the parameters instead
+        # of reading it into RAM and then copying it into freshly built ones
+        state_dict = None
+        try:
+            state_dict = load_optimized_checkpoint_gds(checkpoint_path, device)
+        except Exception as e:
+            print(f"Warning: Could not read optimized checkpoint with kvikio: {e}")
+        if state_dict is None:
+            try:
+                state_dict = load_optimized_checkpoint(checkpoint_path)
+            except Exception as e:
+                print(f"Warning: Could not read optimized checkpoint, using {checkpoint_path.name}: {e}")
+        if state_dict is None:
+            # weights_only: a plain state dict needs no arbitrary unpickling
+            state_dict = torch.load(str(checkpoint_path), map_location="cpu", mmap=True, weights_only=True)
+            try:
+                save_optimized_checkpoint(state_dict, checkpoint_path)
+            except Exception as e:
+                print(f"Warning: Could not save optimized checkpoint: {e}")
+        in_vram = any(tensor.is_cuda for tensor in state_dict.values())
+        if device.type == "cuda" and not in_vram:
+            # Page-locked weights let the upload below run asynchronously on its
+            # own stream, overlapping whatever this process does next
+            state_dict = {name: tensor.pin_memory() for name, tensor in state_dict.items()}
+        sam.load_state_dict(state_dict, assign=True)
+        if device.type == "cuda":
+            upload_stream = torch.cuda.Stream(device=device)
+            with torch.cuda.stream(upload_stream):
+                sam.to(device, non_blocking=True)
+            torch.cuda.current_stream(device).wait_stream(upload_stream)
+        else:
+            sam.to(device)
+        sam.eval()
+        if device.type == "cuda":
+            # Half-precision encoder weights halve its memory traffic; the mask
+            # decoder stays fp32 so score thresholds do not drift
+            encoder_dtype = get_encoder_dtype()
+            sam.image_encoder.to(encoder_dtype)
+            if encoder_dtype != torch.float16:
+                sam.image_encoder = EncoderAutocast(sam.image_encoder, encoder_dtype)
+            print(f"MobileSAM image encoder runs in {encoder_dtype}")
         return SamPredictor(sam)
     except Exception as e:
         print(f"Error: {e}")
         return None
 
 
-# ---------------- MAIN ----------------
-print("\n=== Starting model loading process ===")
-
-print("\n--- Importing model libraries ---")
-grounding_dino_available = import_grounding_dino()
-mobile_sam_available = import_mobile_sam()
-
-print("\n--- Setting up model files ---")
-grounding_dino_files_ready, grounding_dino_config_path = (False, None)
-mobile_sam_files_ready = False
-
-if grounding_dino_available:
-    grounding_dino_files_ready, grounding_dino_config_path = setup_grounding_dino_files()
-if mobile_sam_available:
-    mobile_sam_files_ready = setup_mobile_sam_files()
-
-print("\n--- Loading models ---")
-grounding_dino_model = None
-sam_predictor = None
+class EncoderAutocast(torch.nn.Module):
+    # Inference autocasts to fp16 because its outputs end up in numpy, which has no
+    # bfloat16. The image encoder only feeds the mask decoder, so it can run in
+    # its own precision inside that context.
+    def __init__(self, image_encoder: torch.nn.Module, dtype: torch.dtype):
+        super().__init__()
+        self.image_encoder = image_encoder
+        self.compute_dtype = dtype
+        self.img_size = image_encoder.img_size
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        with torch.autocast(device_type="cuda", dtype=self.compute_dtype,
+                            enabled=self.compute_dtype != torch.float32):
+            return self.image_encoder(x)
+
+
+# ---------------- TENSORRT ----------------
+class TRTImageEncoder(torch.nn.Module):
+    def __init__(self, trt_module: Any, img_size: int):
+        super().__init__()
+        self.trt_module = trt_module
+        # Sam.preprocess pads inputs to image_encoder.img_size
+        self.img_size = img_size
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        # The engine was built for contiguous NCHW fp16 input
+        return self.trt_module(x.half().contiguous())
+
+def use_trt_encoder(sam_predictor: Optional[Any]) -> bool:
+    if not USE_TRT or sam_predictor is None or get_device().type != "cuda":
+        return False
+    try:
+        from torch2trt import torch2trt, TRTModule
+    except ImportError as e:
+        print(f"Warning: USE_TRT=1 but torch2trt is not available: {e}")
+        return False
 
-if grounding_dino_available and grounding_dino_files_ready and grounding_dino_config_path:
-    checkpoint_path = GROUNDING_DINO_DIR / "groundingdino_swint_ogc.pth"
-    grounding_dino_model = load_grounding_dino_model(grounding_dino_config_path, checkpoint_path)
+    engine_path = MOBILE_SAM_DIR / "weights" / "mobile_sam_encoder_trt.pth"
+    try:
+        image_encoder = sam_predictor.model.image_encoder
+        # Build from the plain encoder, not the bf16 autocast wrapper
+        if isinstance(image_encoder, EncoderAutocast):
+            image_encoder = image_encoder.image_encoder
+        size = image_encoder.img_size
+        trt_module = TRTModule()
+        if engine_path.exists():
+            print(f"Loading TensorRT image encoder from {engine_path}")
+            trt_module.load_state_dict(torch.load(str(engine_path)))
+        else:
+            # Building the engine takes minutes; it is saved for the next start
+            print("Building TensorRT image encoder...")
+            device = next(image_encoder.parameters()).device
+            dummy = torch.zeros(1, 3, size, size, device=device, dtype=torch.float16)
+            trt_module = torch2trt(image_encoder.half(), [dummy], fp16_mode=True,
+                                   max_batch_size=TRT_MAX_BATCH, max_workspace_size=1 << 30)
+            torch.save(trt_module.state_dict(), str(engine_path))
+            print(f"TensorRT image encoder saved to {engine_path}")
+        sam_predictor.model.image_encoder = TRTImageEncoder(trt_module, size)
+        return True
+    except Exception as e:
+        print(f"Warning: Could not set up TensorRT image encoder, using PyTorch: {e}")
+        return False
 
-if mobile_sam_available and mobile_sam_files_ready:
-    checkpoint_path = MOBILE_SAM_DIR / "weights" / "mobile_sam.pt"
-    sam_predictor = load_mobile_sam_model(checkpoint_path)
 
-print("\n=== Model loading summary ===")
-print(f"GroundingDINO: {'Loaded' if grounding_dino_model else 'Failed'}")
-print(f"MobileSAM: {'Loaded' if sam_predictor else 'Failed'}")
+# ---------------- COMPILE ----------------
+# Compilation itself is lazy. The webapp warms the models up on its inference
+# thread (app.warm_up_inference): CUDA graphs recorded by mode="reduce-overhead"
+# belong to the thread that recorded them, and each input shape records its own.
+# Only the MobileSAM modules use them; their inputs come in a few fixed shapes.
+# CUDA graphs do not work with CUDA_LAUNCH_BLOCKING=1.
+def compile_models(grounding_dino_model: Optional[Any], sam_predictor: Optional[Any]) -> None:
+    if not SAM_COMPILE or not hasattr(torch, "compile") or get_device().type != "cuda":
+        return
 
-grounding_dino = grounding_dino_model
+    # TF32 matmuls for any float32 work left outside autocast
+    torch.set_float32_matmul_precision("high")
 
-def get_device_lazy():
-    global DEVICE
-    if DEVICE is None:
-        DEVICE = get_device()
-        print(f"Initialized device: {DEVICE}")
-    return DEVICE
+    if sam_predictor is not None:
+        # NHWC lets cuDNN use its tensor-core convolution kernels for the conv stem
+        sam_predictor.model.image_encoder.to(memory_format=torch.channels_last)
+        image_encoder = sam_predictor.model.image_encoder
+        try:
+            print("Compiling MobileSAM image encoder...")
+            # Static shapes: the webapp warms up every batch size it sends
+            sam_predictor.model.image_encoder = torch.compile(
+                image_encoder, mode="reduce-overhead", fullgraph=False, dynamic=False)
+        except Exception as e:
+            print(f"Warning: Could not compile MobileSAM image encoder, using eager mode: {e}")
+            sam_predictor.model.image_encoder = image_encoder
+
+        # The decoder is a long chain of small kernels, so it is launch-bound; CUDA
+        # graphs replay it in one go. One graph is recorded per number of boxes.
+        mask_decoder = sam_predictor.model.mask_decoder
+        try:
+            print("Compiling MobileSAM mask decoder...")
+            sam_predictor.model.mask_decoder = torch.compile(mask_decoder, mode="reduce-overhead", dynamic=False)
+        except Exception as e:
+            print(f"Warning: Could not compile MobileSAM mask decoder, using eager mode: {e}")
+            sam_predictor.model.mask_decoder = mask_decoder
+
+    if grounding_dino_model is not None:
+        model = grounding_dino_model.model
+        try:
+            print("Compiling GroundingDINO model...")
+            # Default mode, without CUDA graphs: the input shape follows each image's
+            # aspect ratio and caption length, and every new shape would record
+            # another graph mid-request
+            grounding_dino_model.model = torch.compile(model, dynamic=True)
+        except Exception as e:
+            print(f"Warning: Could not compile GroundingDINO model, using eager mode: {e}")
+            grounding_dino_model.model = model
+
+def uncompile_models(grounding_dino_model: Optional[Any], sam_predictor: Optional[Any]) -> None:
+    # Back to eager mode, for when a compiled model fails during warm-up
+    if sam_predictor is not None:
+        model = sam_predictor.model
+        model.image_encoder = getattr(model.image_encoder, "_orig_mod", model.image_encoder)
+        model.mask_decoder = getattr(model.mask_decoder, "_orig_mod", model.mask_decoder)
+    if grounding_dino_model is not None:
+        grounding_dino_model.model = getattr(grounding_dino_model.model, "_orig_mod", grounding_dino_model.model)
+
+
+def quantize_sam_decoder(sam_predictor: Optional[Any]) -> None:
+    # CPU only: int8 dynamic quantization of the decoder's Linear layers. On CUDA the
+    # decoder already runs in fp16 under autocast.
+    if sam_predictor is None or get_device().type != "cpu":
+        return
+    try:
+        sam_predictor.model.mask_decoder = torch.ao.quantization.quantize_dynamic(
+            sam_predictor.model.mask_decoder, {torch.nn.Linear}, dtype=torch.qint8)
+        print("MobileSAM mask decoder quantized to int8")
+    except Exception as e:
+        print(f"Warning: Could not quantize MobileSAM mask decoder: {e}")
 
-device = get_device_lazy
 
-print("\n=== Model loader completed ===")
\ No newline at end of file
+# ---------------- MAIN ----------------
+# Models load on first use rather than at import: `from model_loader import
+# grounding_dino` goes through the module __getattr__ below, so importing this
+# module stays cheap for anything that never touches the models
+_grounding_dino_lock = threading.Lock()
+_sam_predictor_lock = threading.Lock()
+# torch.compile is not safe to run from two threads at once
+_compile_lock = threading.Lock()
+
+@functools.lru_cache(maxsize=1)
+def _load_grounding_dino() -> Optional[Any]:
+    print("\n=== Loading GroundingDINO ===")
+    # The checkpoint download does not need the package, so it runs while the
+    # (slow) groundingdino/transformers import happens on this thread
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        files_future = pool.submit(setup_grounding_dino_files)
+        imported = import_grounding_dino()
+        files_ready, config_path = files_future.result()
+    if not (imported and files_ready and config_path):
+        return None
+    checkpoint_path = GROUNDING_DINO_DIR / "groundingdino_swint_ogc.pth"
+    model = load_grounding_dino_model(config_path, checkpoint_path)
+    with _compile_lock:
+        compile_models(model, None)
+    print(f"GroundingDINO: {'Loaded' if model else 'Failed'}")
+    return model
+
+@functools.lru_cache(maxsize=1)
+def _load_sam_predictor() -> Optional[Any]:
+    print("\n=== Loading MobileSAM ===")
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        files_future = pool.submit(setup_mobile_sam_files)
+        imported = import_mobile_sam()
+        files_ready = files_future.result()
+    if not (imported and files_ready):
+        return None
+    checkpoint_path = MOBILE_SAM_DIR / "weights" / "mobile_sam.pt"
+    predictor = load_mobile_sam_model(checkpoint_path)
+    if not use_trt_encoder(predictor):
+        with _compile_lock:
+            compile_models(None, predictor)
+    quantize_sam_decoder(predictor)
+    print(f"MobileSAM: {'Loaded' if predictor else 'Failed'}")
+    return predictor
+
+def get_grounding_dino() -> Optional[Any]:
+    with _grounding_dino_lock:
+        return _load_grounding_dino()
+
+def get_sam_predictor() -> Optional[Any]:
+    with _sam_predictor_lock:
+        return _load_sam_predictor()
+
+def load_all_models() -> tuple[Optional[Any], Optional[Any]]:
+    # The two models share nothing until they run, so their imports, downloads and
+    # checkpoint reads overlap; only the compile steps take turns
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        grounding_dino_future = pool.submit(get_grounding_dino)
+        sam_predictor_future = pool.submit(get_sam_predictor)
+        return grounding_dino_future.result(), sam_predictor_future.result()
+
+def __getattr__(name: str) -> Any:
+    # `device` is a torch.device, resolved on first access like the models
+    if name == "device":
+        return get_device()
+    if name == "grounding_dino":
+        return get_grounding_dino()
+    if name == "sam_predictor":
+        return get_sam_predictor()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,168 @@
+// Elements are looked up once; the script runs after the markup it uses
+const fileUploadArea = document.getElementById('file-upload-area');
+const fileInput = document.getElementById('image_file');
+const filePreview = document.getElementById('file-preview');
+const uploadForm = document.getElementById('upload-form');
+const promptInput = document.getElementById('prompt');
+const submitBtn = document.getElementById('submit-btn');
+const loading = document.getElementById('loading');
+const progress = document.getElementById('upload-progress');
+const loadingText = document.getElementById('loading-text');
+const error = document.getElementById('error');
+const results = document.getElementById('results');
+const originalImage = document.getElementById('original-image');
+const resultImage = document.getElementById('result-image');
+
+// File upload handling
+
+fileUploadArea.addEventListener('click', () => fileInput.click());
+
+fileUploadArea.addEventListener('dragover', (e) => {
+    e.preventDefault();
+    fileUploadArea.classList.add('dragover');
+});
+
+fileUploadArea.addEventListener('dragleave', () => {
+    fileUploadArea.classList.remove('dragover');
+});
+
+fileUploadArea.addEventListener('drop', (e) => {
+    e.preventDefault();
+    fileUploadArea.classList.remove('dragover');
+    const files = e.dataTransfer.files;
+    if (files.length > 0) {
+        fileInput.files = files;
+        handleFileSelect(files[0]);
+    }
+});
+
+fileInput.addEventListener('change', (e) => {
+    if (e.target.files.length > 0) {
+        handleFileSelect(e.target.files[0]);
+    }
+});
+
+// An object URL points the preview at the file itself, instead of reading the
+// whole image into memory and base64-encoding it as a data URL
+let previewUrl = null;
+
+function handleFileSelect(file) {
+    if (file && file.type.startsWith('image/')) {
+        if (previewUrl) {
+            URL.revokeObjectURL(previewUrl);
+        }
+        previewUrl = URL.createObjectURL(file);
+        filePreview.innerHTML = `<img src="${previewUrl}" alt="Preview">`;
+        filePreview.style.display = 'block';
+    }
+}
+
+// Browsers that can encode WebP on a canvas can also display it
+const supportsWebP = document.createElement('canvas').toDataURL('image/webp').startsWith('data:image/webp');
+
+// XMLHttpRequest rather than fetch, since only it reports upload progress
+function postWithProgress(url, formData, onProgress) {
+    return new Promise((resolve, reject) => {
+        const xhr = new XMLHttpRequest();
+        xhr.open('POST', url);
+        xhr.responseType = 'json';
+        xhr.upload.onprogress = (e) => {
+            if (e.lengthComputable) {
+                onProgress(e.loaded / e.total);
+            }
+        };
+        xhr.upload.onload = () => onProgress(1);
+        xhr.onload = () => {
+            if (xhr.status >= 200 && xhr.status < 300) {
+                resolve(xhr.response);
+            } else {
+                reject(new Error(`HTTP error! status: ${xhr.status}`));
+            }
+        };
+        xhr.onerror = () => reject(new Error('Network error'));
+        xhr.send(formData);
+    });
+}
+
+// Form submission
+uploadForm.addEventListener('submit', async function(e) {
+    e.preventDefault();
+    
+    const formData = new FormData(this);
+    if (supportsWebP) {
+        formData.append('webp', '1');
+    }
+    
+    // Validate inputs
+    const imageFile = fileInput.files[0];
+    const prompt = promptInput.value.trim();
+    
+    if (!imageFile) {
+        showError('Please select an image file.');
+        return;
+    }
+    
+    if (!prompt) {
+        showError('Please enter a prompt describing the food item.');
+        return;
+    }
+    
+    // Show loading
+    progress.value = 0;
+    loadingText.textContent = 'Uploading your image...';
+    loading.style.display = 'block';
+    error.style.display = 'none';
+    results.style.display = 'none';
+    submitBtn.disabled = true;
+    submitBtn.innerHTML = '<i class="fas fa-spinner fa-spin"></i> Processing...';
+    
+    try {
+        const result = await postWithProgress('/segment', formData, (fraction) => {
+            if (fraction < 1) {
+                progress.value = Math.round(fraction * 100);
+            } else {
+                // Uploaded; the bar turns indeterminate while the models run
+                progress.removeAttribute('value');
+                loadingText.textContent = 'Processing your image...';
+            }
+        });
+        
+        if (result.success) {
+            // Display base64 images
+            originalImage.src = 'data:' + result.original_mime + ';base64,' + result.original_image;
+            resultImage.src = 'data:' + result.image_mime + ';base64,' + result.result_image;
+            
+            // Show results with animation
+            results.style.display = 'block';
+            results.classList.add('success-animation');
+            
+            // Scroll to results
+            results.scrollIntoView({ behavior: 'smooth' });
+        } else {
+            showError(result.error || 'An error occurred during processing.');
+        }
+    } catch (err) {
+        console.error('Error:', err);
+        showError('An error occurred while processing the image. Please try again.');
+    } finally {
+        loading.style.display = 'none';
+        submitBtn.disabled = false;
+        submitBtn.innerHTML = '<i class="fas fa-magic"></i> Segment Food';
+    }
+});
+
+function showError(message) {
+    error.textContent = message;
+    error.style.display = 'block';
+    error.scrollIntoView({ behavior: 'smooth' });
+}
+
+// Add some interactive effects
+document.addEventListener('DOMContentLoaded', function() {
+    // Add pulse animation to submit button on page load
+    submitBtn.classList.add('pulse');
+    
+    setTimeout(() => {
+        submitBtn.classList.remove('pulse');
+    }, 2000);
+});
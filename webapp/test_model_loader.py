@@ -0,0 +1,74 @@
+import sys
+import types
+from functools import partial
+
+import numpy as np
+import pytest
+import torch
+
+segment_anything = pytest.importorskip("segment_anything")
+from segment_anything import SamPredictor
+from segment_anything.modeling import Sam, ImageEncoderViT, PromptEncoder, MaskDecoder, TwoWayTransformer
+
+import app
+import model_loader
+
+
+def tiny_sam_predictor():
+    # Same architecture as SAM, shrunk so it runs on CPU in a test
+    torch.manual_seed(0)
+    sam = Sam(
+        image_encoder=ImageEncoderViT(img_size=1024, patch_size=16, embed_dim=16, depth=1, num_heads=1,
+                                      out_chans=256, norm_layer=partial(torch.nn.LayerNorm, eps=1e-6)),
+        prompt_encoder=PromptEncoder(embed_dim=256, image_embedding_size=(64, 64),
+                                     input_image_size=(1024, 1024), mask_in_chans=16),
+        mask_decoder=MaskDecoder(num_multimask_outputs=3, transformer_dim=256,
+                                 transformer=TwoWayTransformer(depth=1, embedding_dim=256, mlp_dim=256, num_heads=8)),
+        pixel_mean=[123.675, 116.28, 103.53],
+        pixel_std=[58.395, 57.12, 57.375],
+    ).eval()
+    return SamPredictor(sam)
+
+
+def fake_torch2trt(built_from):
+    # Stands in for torch2trt: the "engine" runs the module it was built from
+    class TRTModule(torch.nn.Module):
+        def __init__(self, module=None):
+            super().__init__()
+            self.module = module
+
+        def forward(self, x):
+            return self.module(x.float())
+
+    def torch2trt(module, inputs, **kwargs):
+        built_from.append(module)
+        return TRTModule(module.float())
+
+    return types.SimpleNamespace(torch2trt=torch2trt, TRTModule=TRTModule)
+
+
+def test_trt_encoder_serves_a_request(monkeypatch, tmp_path):
+    predictor = tiny_sam_predictor()
+    image_encoder = predictor.model.image_encoder
+    # As loaded on a bf16-capable GPU
+    predictor.model.image_encoder = model_loader.EncoderAutocast(image_encoder, torch.bfloat16)
+
+    built_from = []
+    monkeypatch.setitem(sys.modules, "torch2trt", fake_torch2trt(built_from))
+    monkeypatch.setattr(model_loader, "USE_TRT", True)
+    monkeypatch.setattr(model_loader, "get_device", lambda: torch.device("cuda"))
+    monkeypatch.setattr(model_loader, "MOBILE_SAM_DIR", tmp_path)
+    (tmp_path / "weights").mkdir()
+
+    assert model_loader.use_trt_encoder(predictor)
+    assert built_from == [image_encoder]
+    assert isinstance(predictor.model.image_encoder, model_loader.TRTImageEncoder)
+
+    monkeypatch.setattr(app, "sam_predictor", predictor)
+    monkeypatch.setattr(app, "device", torch.device("cpu"))
+    image = np.zeros((600, 800, 3), dtype=np.uint8)
+    with torch.inference_mode():
+        [(features, original_size, input_size)] = app.encode_sam_images([image])
+    assert features.shape == (1, 256, 64, 64)
+    assert original_size == (600, 800)
+    assert input_size == (768, 1024)
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# app.py imports model_loader as a top-level module
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "webapp"))
+
+from app import app